@@ -8,9 +8,13 @@ import plotly.offline as pyo
 import datetime
 import plotly.express as px
 from folium.plugins import MarkerCluster
-import time
 import geopandas as gpd
 from pathlib import Path
+import gzip
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from pandas.api.types import (
     is_categorical_dtype,
@@ -81,6 +85,16 @@ moderate_scenario_df['risk_score'] = moderate_scenario_df['risk_score'].astype(i
 optimist_scenario_df['risk_score'] = optimist_scenario_df['risk_score'].astype(int)
 pessimist_scenario_df['risk_score'] = pessimist_scenario_df['risk_score'].astype(int)
 
+# Create a new column 'id_nom' by merging 'insee' and 'nom_commune'
+geo_data['id_nom'] = geo_data['insee'].astype(str) + ' : ' + geo_data['nom_commune']
+
+# Scenario tables by the name shown in the Scenario tab
+scenario_dataframes = {
+    "Moderate": moderate_scenario_df,
+    "Optimistic": optimist_scenario_df,
+    "Pessimistic": pessimist_scenario_df
+}
+
 
 # =============================================================================
 # FUNCTIONS
@@ -119,6 +133,146 @@ def set_theme():
         """,
         unsafe_allow_html=True
     )
+
+# Function to precompute the filter options of the Maps tab, shared by all sessions
+@st.cache_data(show_spinner=False)
+def build_filter_options():
+    # Commune and year lists for each department, communes in order of appearance
+    communes_by_department = {}
+    years_by_department = {}
+    for department, group in geo_data.groupby('department', sort=False):
+        communes_by_department[department] = group['id_nom'].unique().tolist()
+        years_by_department[department] = sorted(group['year'].unique().tolist(), reverse=True)
+    return {
+        "years": sorted(geo_data['year'].unique().tolist(), reverse=True),
+        "departments": geo_data['department'].unique().tolist(),
+        "communes_by_department": communes_by_department,
+        "years_by_department": years_by_department,
+        "all_communes": geo_data['id_nom'].unique().tolist()
+    }
+
+# Function to precompute the commune options of a scenario
+@st.cache_data(show_spinner=False)
+def build_scenario_commune_options(scenario):
+    commune_options = scenario_dataframes[scenario]["id_nom"].unique().tolist()
+    return commune_options, set(commune_options)
+
+# Function to read the valid values of a query parameter
+def get_query_values(key, options, cast=str):
+    values = []
+    for value in st.query_params.get_all(key):
+        try:
+            value = cast(value)
+        except ValueError:
+            continue
+        if value in options:
+            values.append(value)
+    return values
+
+# Function to read a multiple selection from the URL, an empty value means none selected
+def get_query_selection(key, options, default, cast=str):
+    if key not in st.query_params:
+        return default
+    if st.query_params.get_all(key) == [""]:
+        return []
+    # Fall back to the default when none of the values are valid
+    return get_query_values(key, options, cast) or default
+
+# Function to set the state of a widget from the URL on the first load only
+def init_widget_state(key, value):
+    if key not in st.session_state:
+        st.session_state[key] = value
+
+# Function to write a filter into the URL so the view can be shared
+def set_query_value(key, value):
+    if isinstance(value, (list, tuple)):
+        # An empty selection is kept as an empty value so it is not replaced by the default
+        value = [str(item) for item in value] or [""]
+    elif value is not None:
+        value = [str(value)]
+
+    if value is None:
+        if key in st.query_params:
+            del st.query_params[key]
+    elif st.query_params.get_all(key) != value:
+        st.query_params[key] = value
+
+# Number of rows written per chunk when exporting data
+EXPORT_CHUNK_ROWS = 100_000
+
+# Function to iterate over the filtered rows of a DataFrame in chunks
+def iter_export_chunks(df, mask=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # Resolve the filter to row positions so the full slice is never copied at once
+    if mask is None:
+        positions = np.arange(len(df))
+    else:
+        positions = np.flatnonzero(np.asarray(mask))
+
+    # Always yield at least an empty frame so the export keeps its columns
+    if len(positions) == 0:
+        yield df.iloc[0:0]
+        return
+
+    for start in range(0, len(positions), chunk_rows):
+        yield df.iloc[positions[start:start + chunk_rows]]
+
+# Function to write chunks to a temporary file as Parquet or gzip CSV
+def write_export(chunks, file_format):
+    # Only the uncompressed rows and CSV text are kept out of memory, the compressed
+    # file is returned whole, so it only spills over to disk while it is being written
+    export_file = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+
+    if file_format == "Parquet":
+        writer = None
+        try:
+            for chunk in chunks:
+                # Object columns are stored as text, so the schema follows the dtypes of the
+                # full table and not the values of the first chunk
+                object_columns = chunk.columns[chunk.dtypes == object]
+                chunk = chunk.astype({column: "string" for column in object_columns})
+                table = pa.Table.from_pandas(chunk, schema=writer.schema if writer else None, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(export_file, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with gzip.GzipFile(fileobj=export_file, mode="wb") as gz:
+            header = True
+            for chunk in chunks:
+                gz.write(chunk.to_csv(index=False, header=header).encode("utf-8"))
+                header = False
+
+    export_file.seek(0)
+    return export_file
+
+# Function to build the export file and return its content
+def build_export(df, mask, file_format):
+    # Streamlit keeps the download as bytes, so the whole compressed file is held in memory
+    with write_export(iter_export_chunks(df, mask), file_format) as export_file:
+        return export_file.read()
+
+# Function to display the export controls for a filtered DataFrame
+def export_data(df, mask, file_name, key):
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        file_format = st.radio("Export format", ["Parquet", "CSV (gzip)"], horizontal=True, key=f"{key}_format")
+
+    extension = "parquet" if file_format == "Parquet" else "csv.gz"
+    mime = "application/vnd.apache.parquet" if file_format == "Parquet" else "application/gzip"
+
+    # The file is only built when the button is clicked, not on every rerun of the app
+    with col2:
+        st.download_button(
+            "Download data",
+            data=lambda: build_export(df, mask, file_format),
+            file_name=f"{file_name}.{extension}",
+            mime=mime,
+            on_click="ignore",
+            key=f"{key}_download"
+        )
+
 # Set page config
 st.set_page_config(
     page_title="Data App",
@@ -207,6 +361,17 @@ def main():
             
             return m1
         
+        # Function to render the map once per combination of filters, only the latest maps are kept
+        @st.cache_data(show_spinner="MAP loading. Please wait.", max_entries=32, ttl=3600)
+        def render_risk_map_html(year, departments, insee_codes, selected_risk_scores):
+            filtered_geo_data = geo_data[
+                (geo_data['id_nom'].isin(insee_codes)) & 
+                (geo_data['risk_score'].isin(selected_risk_scores)) & 
+                (geo_data['year'] == year)
+            ]
+            folium_map = create_risk_map_for_year_department_insee(filtered_geo_data, year, departments, insee_codes, selected_risk_scores)
+            return folium_map._repr_html_() if folium_map else None
+        
         # Function to create a filtered plot
         def create_filtered_plot(geo_data, department, selected_year_range):
             # Filter data for the specified department
@@ -236,31 +401,58 @@ def main():
         # Define the default year range for the plot
         default_plot_year_range = (1990, 2000)
         
+        # Precomputed options for the filters
+        filter_options = build_filter_options()
+        year_options = filter_options["years"]
+        
         # Determine the range of years in the dataset
-        min_year = int(geo_data['year'].min())
-        max_year = int(geo_data['year'].max())
+        min_year = int(min(year_options))
+        max_year = int(max(year_options))
         
-        # Year filter with a dropdown
         col1, col2, col3 = st.columns(3)
-        with col1:
-            year_options = sorted(geo_data['year'].unique().tolist(), reverse=True)
-            selected_year = st.selectbox("Select a year", options=year_options)
         
-        # Department filter
+        # Department filter, built first as the year options depend on it
         with col2:
-            department_options = geo_data['department'].unique().tolist()
-            selected_departments = st.multiselect("Select Department(s)", options=department_options, default=["Pas_De_Calais"])
+            department_options = filter_options["departments"]
+            init_widget_state("maps_departments", get_query_selection("dept", department_options, ["Pas_De_Calais"]))
+            selected_departments = st.multiselect("Select Department(s)", options=department_options, key="maps_departments")
+        
+        # Year filter with a dropdown, limited to the years of the selected departments
+        with col1:
+            if selected_departments:
+                department_year_options = sorted(
+                    {year for department in selected_departments for year in filter_options["years_by_department"][department]},
+                    reverse=True
+                )
+            else:
+                department_year_options = year_options
+            query_years = get_query_values("year", department_year_options, cast=int)
+            init_widget_state("maps_year", query_years[0] if query_years else department_year_options[0])
+            # Reset the year when it does not exist for the selected departments
+            if st.session_state["maps_year"] not in department_year_options:
+                st.session_state["maps_year"] = department_year_options[0]
+            selected_year = st.selectbox("Select a year", options=department_year_options, key="maps_year")
         
         # Multiselect to choose communes
+        selected_communes = []
         with col3:
-            geo_data['id_nom'] = geo_data['insee'].astype(str) + ' : ' + geo_data['nom_commune']
             if selected_departments:
-                filtered_insee_options = geo_data.loc[geo_data['department'].isin(selected_departments), 'id_nom'].unique().tolist()
+                filtered_insee_options = [
+                    commune
+                    for department in selected_departments
+                    for commune in filter_options["communes_by_department"][department]
+                ]
             else:
-                filtered_insee_options = geo_data['id_nom'].unique().tolist()
+                filtered_insee_options = filter_options["all_communes"]
             
             if selected_departments:
-                selected_communes = st.multiselect("Select Commune(s)", options=filtered_insee_options, default=filtered_insee_options if not selected_departments else [])
+                commune_option_set = set(filtered_insee_options)
+                init_widget_state("maps_communes", get_query_values("commune", commune_option_set))
+                # Drop the communes of departments that are no longer selected
+                st.session_state["maps_communes"] = [
+                    commune for commune in st.session_state["maps_communes"] if commune in commune_option_set
+                ]
+                selected_communes = st.multiselect("Select Commune(s)", options=filtered_insee_options, key="maps_communes")
                 if not selected_communes:
                     st.caption("All Communes chosen by default")
                     
@@ -270,51 +462,53 @@ def main():
         st.caption("Select Risk Scores")
         risk_score_labels = {0: "No expected flood risk", 1: "Low risk", 2: "Moderate risk", 3: "High risk"}
         selected_risk_scores = []
+        default_risk_scores = get_query_selection("risk", risk_score_labels, list(risk_score_labels), cast=int)
         risk_score_cols = st.columns(len(risk_score_labels))
         for idx, (score, label) in enumerate(risk_score_labels.items()):
-            if risk_score_cols[idx].checkbox(f"Risk Score: {label}", value=True):
+            init_widget_state(f"maps_risk_{score}", score in default_risk_scores)
+            if risk_score_cols[idx].checkbox(f"Risk Score: {label}", key=f"maps_risk_{score}"):
                 selected_risk_scores.append(score)
         
+        # Keep the Maps filters in the URL
+        set_query_value("year", selected_year)
+        set_query_value("dept", selected_departments)
+        set_query_value("commune", selected_communes)
+        set_query_value("risk", selected_risk_scores)
+        
         # Ensure all communes are selected by default if none are selected
         if not selected_communes:
             selected_communes = filtered_insee_options
 
         # Create the map with selected filters
-        filtered_geo_data = geo_data[
+        filtered_mask = (
             (geo_data['id_nom'].isin(selected_communes)) & 
             (geo_data['risk_score'].isin(selected_risk_scores)) & 
             (geo_data['year'] == selected_year)
-        ]
+        )
         
         st.divider() # a horizontal rule    
         st.header(f"Map of Department {', '.join(selected_departments)} Flood(s)")          
         
-        # Progress bar for map loading
-        progress_text = "MAP loading. Please wait."
-        my_bar = st.progress(0, text=progress_text)
-        
-        for percent_complete in range(100):
-            time.sleep(0.01)
-            my_bar.progress(percent_complete + 1, text=progress_text)
-            
-        # Load the map
-        folium_map = create_risk_map_for_year_department_insee(filtered_geo_data, selected_year, selected_departments, selected_communes, selected_risk_scores)
+        # Load the map, a spinner is only shown when it is not cached yet
+        folium_map_html = render_risk_map_html(selected_year, selected_departments, selected_communes, selected_risk_scores)
         
         # Risk score checkboxes in horizontal format
         
         
         
         # Display the map or a message if there are NaNs or no data
-        if folium_map:
-            st.components.v1.html(folium_map._repr_html_(), width=1350, height=600, scrolling=True)
+        if folium_map_html:
+            st.components.v1.html(folium_map_html, width=1350, height=600, scrolling=True)
         else:
             st.write("Sorry either the values are Null, or this data does not exist.")
-        
-        my_bar.empty()
                
         
         st.divider() # a horizontal rule
         
+        # Export the filtered map data
+        st.subheader("Export Map Data")
+        export_data(geo_data, filtered_mask, f"flood_map_{selected_year}", key="maps_export")
+        
         
 
 
@@ -373,14 +567,19 @@ def main():
     
       # Slider for plot year range
         st.caption("Filter Range of Risk Year(s) for Plot")
+        query_year_range = get_query_values("range", range(min_year, max_year + 1), cast=int)
+        if len(query_year_range) == 2:
+            default_plot_year_range = (min(query_year_range), max(query_year_range))
+        init_widget_state("risk_year_range", default_plot_year_range)
         selected_plot_year_range = st.slider(
             "Select Year Range",
             min_value=min_year,
             max_value=max_year,
-            value=default_plot_year_range,
             step=1,
-            format="%d"
+            format="%d",
+            key="risk_year_range"
         )
+        set_query_value("range", selected_plot_year_range)
         
         # Load the plot for "Nord"
         fig_nord = create_filtered_plot(geo_data, "Nord", selected_plot_year_range)
@@ -430,6 +629,14 @@ def main():
         # Display heatmaps in Streamlit
         st.plotly_chart(fig_Nord, use_container_width=True, height=600)
         st.plotly_chart(fig_Pas_De_Calais, use_container_width=True, height=600)
+        
+        # Export the risk data for the selected year range
+        st.subheader("Export Risk Data")
+        risk_mask = (
+            (geo_data['department'].isin(["Nord", "Pas_De_Calais"])) &
+            (geo_data['year'].between(selected_plot_year_range[0], selected_plot_year_range[1]))
+        )
+        export_data(geo_data, risk_mask, f"flood_risk_{selected_plot_year_range[0]}_{selected_plot_year_range[1]}", key="risk_export")
 
    
 
@@ -440,28 +647,27 @@ def main():
     
     # Tab 4: Scenarios
     with tab4:
-        # Create a session state variable to track the selected commune index
-        if 'selected_commune_index' not in st.session_state:
-            st.session_state.selected_commune_index = 0  # Initialize to 0, which corresponds to "Clairmarais"
-    
         # Default selected dataframe
-        selected_df = st.selectbox("Select your Scenario", ["Moderate", "Optimistic", "Pessimistic"], index=1)
+        scenario_options = list(scenario_dataframes)
+        query_scenarios = get_query_values("scenario", scenario_options)
+        init_widget_state("scenario", query_scenarios[0] if query_scenarios else "Optimistic")
+        selected_df = st.selectbox("Select your Scenario", scenario_options, key="scenario")
     
-        # Get the selected dataframe and set the default descriptive text
+        # Get the selected dataframe
+        df = scenario_dataframes[selected_df]
+    
+        # Set the default descriptive text
         if selected_df == "Moderate":
-            df = moderate_scenario_df
             scenario_name = "moderate"
             scenario_description = "moderate risk"
             expenditure_change = "wouldn’t change from"
             percentage_change = ""
         elif selected_df == "Optimistic":
-            df = optimist_scenario_df
             scenario_name = "optimistic"
             scenario_description = "no expected flood risk"
             expenditure_change = "would decrease by 25% to reach"
             percentage_change = "decrease"
         else:
-            df = pessimist_scenario_df
             scenario_name = "pessimistic"
             scenario_description = "low risk"
             expenditure_change = "would increase by 25% to reach"
@@ -493,16 +699,23 @@ def main():
         with st.container():
             # Filter by 'id_nom'
             # Filter by 'id_nom'
-            commune_options = df["id_nom"].unique().tolist()
+            commune_options, commune_option_set = build_scenario_commune_options(selected_df)
             default_commune = "Clairmarais"
             
             # Check if the default commune exists in the options
-            if default_commune in commune_options:
-                default_index = commune_options.index(default_commune)
-            else:
-                default_index = 0  # Fall back to the first option if not found
+            if default_commune not in commune_option_set:
+                default_commune = commune_options[0]  # Fall back to the first option if not found
             
-            selected_id_nom = st.selectbox("Select Commune", options=commune_options, index=default_index)
+            init_widget_state("scenario_commune", st.query_params.get("scenario_commune", default_commune))
+            # Reset the commune when it is not part of the selected scenario
+            if st.session_state["scenario_commune"] not in commune_option_set:
+                st.session_state["scenario_commune"] = default_commune
+            
+            selected_id_nom = st.selectbox("Select Commune", options=commune_options, key="scenario_commune")
+            
+            # Keep the Scenario filters in the URL
+            set_query_value("scenario", selected_df)
+            set_query_value("scenario_commune", selected_id_nom)
             
              
             # Filter the DataFrame based on the selected 'id_nom' and the year 2024
@@ -552,6 +765,10 @@ def main():
            
                 st.divider()
 
+        # Export the selected scenario table
+        st.subheader("Export Scenario Data")
+        export_data(df, None, f"{scenario_name}_scenario", key="scenario_export")
+
 
         st.subheader("Historical Depreciation information")
 ############################    